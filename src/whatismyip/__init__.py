@@ -21,38 +21,64 @@ Example:
 __version__ = '2024.2.20'
 
 import re
-import binascii
+import concurrent.futures
+import functools
+import http.client
+import itertools
+import os
 import random
 import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
 
-from typing import Optional, Pattern, Tuple, Sequence
+from typing import Any, Callable, Dict, List, Optional, Pattern, Sequence, Tuple
 
 # From https://stackoverflow.com/a/5284410/1893164
-IPV4_REGEX = re.compile(r"""((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(\.|$)){4}""")  # type: Pattern
+# (The groups are non-capturing since only the match itself is used, and the end is anchored so that trailing
+# garbage like '1.2.3.4.', '1.2.3.45x', or a trailing newline doesn't match. ($ would allow a trailing newline.)
+IPV4_REGEX = re.compile(r"""(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\Z""",
+                        re.ASCII)  # type: Pattern
 
 # From https://stackoverflow.com/a/17871737/1893164
-IPV6_REGEX = re.compile(
-    r"""(
-([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|          # 1:2:3:4:5:6:7:8
-([0-9a-fA-F]{1,4}:){1,7}:|                         # 1::                              1:2:3:4:5:6:7::
-([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|         # 1::8             1:2:3:4:5:6::8  1:2:3:4:5:6::8
-([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|  # 1::7:8           1:2:3:4:5::7:8  1:2:3:4:5::8
-([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|  # 1::6:7:8         1:2:3:4::6:7:8  1:2:3:4::8
-([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|  # 1::5:6:7:8       1:2:3::5:6:7:8  1:2:3::8
-([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|  # 1::4:5:6:7:8     1:2::4:5:6:7:8  1:2::8
-[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|       # 1::3:4:5:6:7:8   1::3:4:5:6:7:8  1::8
-:((:[0-9a-fA-F]{1,4}){1,7}|:)|                     # ::2:3:4:5:6:7:8  ::2:3:4:5:6:7:8 ::8       ::
-fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|     # fe80::7:8%eth0   fe80::7:8%1     (link-local IPv6 addresses with zone index)
-::(ffff(:0{1,4}){0,1}:){0,1}
-((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}
-(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|          # ::255.255.255.255   ::ffff:255.255.255.255  ::ffff:0:255.255.255.255  (IPv4-mapped IPv6 addresses and IPv4-translated addresses)
-([0-9a-fA-F]{1,4}:){1,4}:
-((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}
-(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])           # 2001:db8:3:4::192.0.2.33  64:ff9b::192.0.2.33 (IPv4-Embedded IPv6 Address)
-)""",
-    re.VERBOSE,
-)  # type: Pattern
+# (On Python 3.7 and later, this isn't compiled until IPV6_REGEX is first accessed. See __getattr__() below.)
+_IPV6_PATTERN = r"""(?:
+(?:[0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|             # 1:2:3:4:5:6:7:8
+(?:[0-9a-fA-F]{1,4}:){1,7}:|                            # 1::                              1:2:3:4:5:6:7::
+(?:[0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|            # 1::8             1:2:3:4:5:6::8  1:2:3:4:5:6::8
+(?:[0-9a-fA-F]{1,4}:){1,5}(?::[0-9a-fA-F]{1,4}){1,2}|   # 1::7:8           1:2:3:4:5::7:8  1:2:3:4:5::8
+(?:[0-9a-fA-F]{1,4}:){1,4}(?::[0-9a-fA-F]{1,4}){1,3}|   # 1::6:7:8         1:2:3:4::6:7:8  1:2:3:4::8
+(?:[0-9a-fA-F]{1,4}:){1,3}(?::[0-9a-fA-F]{1,4}){1,4}|   # 1::5:6:7:8       1:2:3::5:6:7:8  1:2:3::8
+(?:[0-9a-fA-F]{1,4}:){1,2}(?::[0-9a-fA-F]{1,4}){1,5}|   # 1::4:5:6:7:8     1:2::4:5:6:7:8  1:2::8
+[0-9a-fA-F]{1,4}:(?:(?::[0-9a-fA-F]{1,4}){1,6})|        # 1::3:4:5:6:7:8   1::3:4:5:6:7:8  1::8
+:(?:(?::[0-9a-fA-F]{1,4}){1,7}|:)|                      # ::2:3:4:5:6:7:8  ::2:3:4:5:6:7:8 ::8       ::
+fe80:(?::[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|        # fe80::7:8%eth0   fe80::7:8%1     (link-local IPv6 addresses with zone index)
+::(?:ffff(?::0{1,4}){0,1}:){0,1}
+(?:(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}
+(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])|           # ::255.255.255.255   ::ffff:255.255.255.255  ::ffff:0:255.255.255.255  (IPv4-mapped IPv6 addresses and IPv4-translated addresses)
+(?:[0-9a-fA-F]{1,4}:){1,4}:
+(?:(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}
+(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])            # 2001:db8:3:4::192.0.2.33  64:ff9b::192.0.2.33 (IPv4-Embedded IPv6 Address)
+)\Z"""
+
+
+def __getattr__(name):
+    # type: (str) -> Any
+    """Compiles IPV6_REGEX the first time it's accessed. The module doesn't use it itself, so there's no reason to
+    compile this large verbose pattern on every import."""
+    if name == 'IPV6_REGEX':
+        global IPV6_REGEX
+        IPV6_REGEX = re.compile(_IPV6_PATTERN, re.VERBOSE)  # type: Pattern
+        return IPV6_REGEX
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__() (PEP 562) was added in Python 3.7, so older versions have to compile IPV6_REGEX right away.
+    IPV6_REGEX = re.compile(_IPV6_PATTERN, re.VERBOSE)  # type: Pattern
 
 
 # If you have an IPv4 *and* IPv6 address, these websites give you your IPv4 address.
@@ -81,9 +107,31 @@ IP6_WEBSITES = ('https://icanhazip.com',
 
 IP_WEBSITES = IP4_WEBSITES + IP6_WEBSITES
 
+# Headers sent with every request to the IP websites.
+HTTP_HEADERS = {'User-Agent': 'whatismyip/' + __version__}
+
+# How many seconds to wait on a single IP website before giving up on it.
+HTTPS_TIMEOUT = 2
+
+# The most bytes read from an IP website's response. Any IP address (plus whitespace) fits in well under this, so
+# longer responses aren't IP addresses and aren't worth downloading.
+_MAX_RESPONSE_LENGTH = 64
+
+# How many IP websites to query at the same time.
+HTTPS_PARALLEL_REQUESTS = 4
+
+# How many seconds whatismyip() and whatismyipv4() wait on the STUN servers before also querying the IP websites.
+STUN_HEAD_START = 0.25
+
+# How often (in seconds) a STUN lookup checks whether it has been told to stop, because the websites answered first.
+_STUN_STOP_CHECK_INTERVAL = 0.05
+
 # TODO - add other websites that provide this info in a web page, along with a regex that can pull out the IP address.
 # Example: http://checkip.dyndns.org
 
+# How many seconds amionline() waits for the web server lookups before deciding that the system is offline.
+AMIONLINE_TIMEOUT = 2
+
 # Popular web servers to test if we are online. (2024/02/20 - youtube.com was removed since it is blocked in some countries)
 ONLINE_WEB_SERVERS = ('google.com', 'facebook.com', 'yahoo.com', 'reddit.com', 'wikipedia.org', 'ebay.com', 'bing.com', 'netflix.com', 'office.com', 'twitch.com', 'cnn.com', 'linkedin.com')
 
@@ -95,59 +143,147 @@ ONLINE_WEB_SERVERS = ('google.com', 'facebook.com', 'yahoo.com', 'reddit.com', '
 # Tested on 2024/02/20 from Brooklyn, NY, USA:
 STUN_SERVERS = ('stun.freeswitch.org:3478', 'stun.l.google.com:19302', 'stun.l.google.com:3478', 'stun.voip.blackberry.com:3478', 'stun.vivox.com:3478', 'stun.usfamily.net:3478', 'stun.epygi.com:3478', 'stun.voipzoom.com:3478', 'stun.rynga.com:3478', 'stun2.l.google.com:19302', 'stun.voipbusterpro.com:3478', 'stun.cheapvoip.com:3478', 'stun.easyvoip.com:3478', 'stun.lowratevoip.com:3478', 'stun.nonoh.net:3478', 'stun.siptraffic.com:3478', 'stun.voipinfocenter.com:3478', 'stun.webcalldirect.com:3478', 'stun.freecall.com:3478', 'stun.justvoip.com:3478', 'stun.voicetrading.com:3478', 'stun.dcalling.de:3478', 'stun.liveo.fr:3478', 'stun.voip.aebc.com:3478', 'stun.ippi.fr:3478', 'stun.12voip.com:3478', 'stun3.l.google.com:19302', 'stun.jumblo.com:3478', 'stun.voipstunt.com:3478', 'stun.internetcalls.com:3478', 'stun.freevoipdeal.com:3478', 'stun.voipcheap.com:3478', 'stun.voipraider.com:3478', 'stun.actionvoip.com:3478', 'stun.powervoip.com:3478', 'stun.myvoiptraffic.com:3478', 'stun.intervoip.com:3478', 'stun.smartvoip.com:3478', 'stun.telbo.com:3478', 'stun.voipblast.com:3478', 'stun.voipgain.com:3478', 'stun.netappel.com:3478', 'stun.acrobits.cz:3478', 'stun.antisip.com:3478', 'stun.voipwise.com:3478', 'stun.voipgate.com:3478', 'stun.zadarma.com:3478', 'stun.twt.it:3478', 'stun.solnet.ch:3478', 'stun4.l.google.com:19302', 'stun.voippro.com:3478', 'stun.mywatson.it:3478', 'stun.t-online.de:3478', 'stun.ppdi.com:3478', 'stun.tng.de:3478', 'stun.siplogin.de:3478', 'stun.linphone.org:3478', 'stun.sipgate.net:10000', 'stun.gmx.de:3478', 'stun.voipcheap.co.uk:3478', 'stun.aeta.com:3478', 'stun.1und1.de:3478', 'stun.aeta-audio.com:3478', 'stun.callromania.ro:3478', 'stun.gmx.net:3478', 'stun.schlund.de:3478', 'stun.voip.eutelia.it:3478', 'stun.bluesip.net:3478', 'stun.voztele.com:3478', 'stun.rockenstein.de:3478', 'stun.voipbuster.com:3478', 'stun.it1.hr:3478', 'stun.12connect.com:3478', 'stun.zoiper.com:3478', 'stun.voys.nl:3478', 'stun.nextcloud.com:443', 'stun.dus.net:3478', 'stun.poivy.com:3478', 'stun.ipshka.com:3478', 'stun.halonet.pl:3478', 'stun1.l.google.com:19302', 'stun.cablenet-as.net:3478', 'stun.annatel.net:3478', 'stun.cope.es:3478', 'stun.hoiio.com:3478', 'stun.uls.co.za:3478')
 
+# The fastest of the STUN_SERVERS (which are sorted by response time). By default, whatismyip() and whatismyipv4() pick
+# the servers to ask from these, since querying slower ones in parallel just adds sockets without making the response
+# any faster. (There are more of these than are asked at once, so that servers that stop responding can be replaced.)
+FAST_STUN_SERVERS = STUN_SERVERS[:15]
+
+# STUN_SERVERS and FAST_STUN_SERVERS split into (host, port) tuples once, instead of on every request:
+_STUN_SERVERS_PARSED = tuple((host, int(port)) for host, port in (stunServer.split(':') for stunServer in STUN_SERVERS))
+_FAST_STUN_SERVERS_PARSED = _STUN_SERVERS_PARSED[:len(FAST_STUN_SERVERS)]
+
+
+# Idle keep-alive connections to the IP websites, keyed by (scheme, host, port). Reusing these skips the TCP and
+# TLS handshakes on repeated calls. Connections are popped off while in use, so no two threads share one.
+_HTTP_CONNECTIONS = {}  # type: Dict[Tuple[str, str, Optional[int]], List[http.client.HTTPConnection]]
+_HTTP_CONNECTIONS_LOCK = threading.Lock()
+
+# Worker threads for the STUN lookups and the IP website requests, created once and reused by every call instead of
+# starting new threads each time. Each whatismyip() call uses up to 1 + HTTPS_PARALLEL_REQUESTS of them, so this is
+# enough for several calls at once. (Threads are only started as they're needed.)
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=32)
 
-# STUN attributes, in hex:
-MAPPED_ADDRESS = '0001'
+# Worker threads for DNS lookups. The STUN lookups running on _EXECUTOR wait on these, so they must have their own
+# threads: if they were queued on _EXECUTOR, they could be stuck behind the very STUN lookups waiting for them. This
+# also keeps DNS lookups that hang (which can't be cancelled) from holding up the IP website requests.
+_DNS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+
+# STUN attributes, as the ints that struct packs and unpacks:
+_MAPPED_ADDRESS = 0x0001
+_XOR_MAPPED_ADDRESS = 0x0020
 STUN_ATTR_LEN = 4
 
-# STUN message types, in hex:
-BIND_REQUEST_MSG = '0001'
-BIND_RESPONSE_MSG = '0101'
+# STUN message types:
+_BIND_REQUEST = 0x0001
+_BIND_RESPONSE = 0x0101
+
+# The first 4 bytes of an RFC 5389 transaction ID. XOR-MAPPED-ADDRESS values are XORed with these bytes.
+_MAGIC_COOKIE = b'\x21\x12\xa4\x42'
+
+# The response history of each STUN server, mapping (host, port) to (number of successes, number of failures, average
+# latency in seconds). The servers in STUN_SERVERS start out as if they had one response, from 0 up to 0.3 seconds
+# depending on their place in the (profiled) order. Any other server starts out with _DEFAULT_STUN_STATS.
+_STUN_STATS = {}  # type: Dict[Tuple[str, int], Tuple[int, int, float]]
+_STUN_STATS.update((stunServer, (1, 0, 0.3 * i / len(_STUN_SERVERS_PARSED)))
+                   for i, stunServer in enumerate(_STUN_SERVERS_PARSED))
+_STUN_STATS_LOCK = threading.Lock()
+_DEFAULT_STUN_STATS = (1, 0, 0.2)
+
+# How many seconds to remember the resolved address of a STUN server.
+DNS_CACHE_TTL = 3600
+
+# Resolved STUN server addresses, mapping (host, port) to (sockaddr, expiration time).
+_DNS_CACHE = {}  # type: Dict[Tuple[str, int], Tuple[Tuple[str, int], float]]
+
+# How many seconds the public functions remember the IP address they returned before looking it up again. These are
+# only the starting values: to change a function's cache time, set its ttl attribute (see _ttl_cache()).
+_CACHE_TTL = 60
+
+# Local IP addresses rarely change, so whatismylocalip() remembers them for longer.
+_LOCAL_IP_CACHE_TTL = 300
+
+
+def _ttl_cache(ttl):
+    # type: (float) -> Callable
+    """Decorator that remembers the decorated function's return value for each set of arguments for ttl seconds, so that
+    repeated calls don't send new requests to the STUN servers and websites. None results aren't cached. The decorated
+    function's ttl attribute can be changed (set it to 0 to turn caching off), and its cache_clear() method forgets all
+    of the remembered values."""
+    def decorator(func):
+        cache = {}  # type: Dict[Tuple, Tuple[Any, float]]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            now = time.time()
+            cached = cache.get(key)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+
+            result = func(*args, **kwargs)
+            if result is not None:
+                cache[key] = (result, now + wrapper.ttl)
+            return result
+
+        wrapper.ttl = ttl
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
 
 # Note: Because this module is named whatismyip and it's a small module that likely people will only use for its
 # whatismyip() function, I've kept the all lowercase, no underscore naming convention for the public functions.
 # It would be too confusing to have whatismyip.what_is_my_ip(). Please don't complain about pep8 to me.
 
-def whatismyip():
-    # type: (Optional[Sequence[str]]) -> Optional[str]
+@_ttl_cache(_CACHE_TTL)
+def whatismyip(fast=True):
+    # type: (bool) -> Optional[str]
     """Returns a str of your IP address, either IPv4 or IPv6. If offline or
-    the IP address can't be determined, this returns None."""
+    the IP address can't be determined, this returns None.
+
+    :param fast: If True, only ask STUN servers from FAST_STUN_SERVERS,
+    otherwise ask servers from all of STUN_SERVERS."""
 
     # Get ipv4 address from STUN servers first (they tend to be faster than the websites):
     # Note: STUN servers only return IPv4 addresses. This means that whatismyip() will almost
     # always return the IPv4 address of users who have both IPv4 and IPv6 addresses.
     # (TODO: Test this claim.)
-    for i in range(3):  # Make 3 attempts, otherwise assume accessing STUN is blocked for some reason.
-        ip = _get_ip_from_stun()  # Check a random STUN server.
-        if ip is not None:
-            return ip
+    return _get_ip_from_stun_or_https(_FAST_STUN_SERVERS_PARSED if fast else _STUN_SERVERS_PARSED)
 
-    return _get_ip_from_https()
 
-
-def whatismyipv4():
-    # type: () -> Optional[str]
+@_ttl_cache(_CACHE_TTL)
+def whatismyipv4(fast=True):
+    # type: (bool) -> Optional[str]
     """Returns a str of your IPv4 address. If offline or the IP address can't
-    be determined, this returns None."""
+    be determined, this returns None.
+
+    :param fast: If True, only ask STUN servers from FAST_STUN_SERVERS,
+    otherwise ask servers from all of STUN_SERVERS."""
 
     # Get ipv4 address from STUN servers first (they tend to be faster than the websites):
     # Note: STUN servers only return IPv4 addresses. (TODO: Test this claim.)
-    for i in range(3):  # Make 3 attempts, otherwise assume accessing STUN is blocked for some reason.
-        ip = _get_ip_from_stun()  # Check a random STUN server.
-        if ip is not None:
-            return ip
-
-    return _get_ip_from_https(4)
+    return _get_ip_from_stun_or_https(_FAST_STUN_SERVERS_PARSED if fast else _STUN_SERVERS_PARSED, 4)
 
 
+@_ttl_cache(_CACHE_TTL)
 def whatismyipv6():
     # type: () -> Optional[str]
     """Returns a str of your IPv6 address, or None if offline or you don't have an IPv6 address."""
     return _get_ip_from_https(6)
 
 
+@_ttl_cache(_LOCAL_IP_CACHE_TTL)
 def whatismylocalip():
-    return tuple(socket.gethostbyname_ex(socket.gethostname())[2])
+    # type: () -> Tuple[str, ...]
+    """Returns a tuple of strs of the local IPv4 addresses of this computer's network cards."""
+    addrInfos = socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET, socket.SOCK_DGRAM)
+    # Remove any duplicate addresses but keep them in the order they were returned:
+    localIps = []  # type: List[str]
+    for addrInfo in addrInfos:
+        if addrInfo[4][0] not in localIps:
+            localIps.append(addrInfo[4][0])
+    return tuple(localIps)
 
 
 def whatismyhostname():
@@ -158,7 +294,8 @@ def whatismyhostname():
 def amionline(web_servers=None): # type: (Optional[List[str]]) -> bool
     """Return True if the system is currently on the internet, otherwise returns False.
 
-    It determines this by attempting to connect to a popular web server in the `ONLINE_WEB_SERVERS` list.
+    It determines this by attempting to connect to a popular web server in the `ONLINE_WEB_SERVERS` list. If the system
+    has no network route to the internet, this returns False right away without trying any web servers.
 
     :param web_servers: A list of web server domain names to check for connectivity (or `ONLINE_WEB_SERVERS` if
         None), defaults to None.
@@ -166,31 +303,116 @@ def amionline(web_servers=None): # type: (Optional[List[str]]) -> bool
     :return: True if the system is online, False if not online.
     :rtype: bool
     """
-    # If web_servers is not provided, use the default list of popular web servers.
+    # If there's no route to the internet at all, don't bother waiting on DNS lookups that are bound to fail.
+    if not _has_internet_route():
+        return False
+
+    # If web_servers is not provided, use the default list of popular web servers. (This makes a copy, so that
+    # shuffling it doesn't change the caller's list.)
     if web_servers is None:
         web_servers = list(ONLINE_WEB_SERVERS)
+    else:
+        web_servers = list(web_servers)
 
     # Shuffle the list of web servers to try a random sequence.
     random.shuffle(web_servers)
 
-    # Try to connect to up to 3 randomly selected web servers.
-    for i in range(3):
-        try:
-            # Attempt to get address information for the current web server.
-            socket.getaddrinfo(web_servers[i], 'www')
-            # If successful, return True to indicate that the system is online.
-            return True
-        except socket.gaierror:
-            # If an error occurs, continue to the next server in the shuffled list.
-            continue
+    # Look up 3 randomly selected web servers at the same time, instead of waiting on each lookup in turn.
+    futures = [_DNS_EXECUTOR.submit(socket.getaddrinfo, webServer, 'www') for webServer in web_servers[:3]]
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=AMIONLINE_TIMEOUT):
+            # If any lookup succeeds, return True to indicate that the system is online.
+            if future.exception() is None:
+                return True
+    except concurrent.futures.TimeoutError:
+        pass  # The lookups that haven't finished yet are taking too long.
 
     # If all three attempts have failed, return False to indicate that the system is offline.
     return False
 
 # Note: Private functions will use snake_case.
 
-def _get_ip_from_https(ip_version=None, web_servers=None):
-    # type: (Optional[int], Optional[Sequence[str]]) -> Optional[str]
+def _has_internet_route():
+    # type: () -> bool
+    """Returns True if the system has a network route to a public IPv4 or IPv6 address. This is only a local check:
+    "connecting" a UDP socket doesn't send any packets, it just fails right away if there's no route."""
+    for family, address in ((socket.AF_INET, ('1.1.1.1', 53)), (socket.AF_INET6, ('2606:4700:4700::1111', 53))):
+        try:
+            sockObj = socket.socket(family, socket.SOCK_DGRAM)
+        except OSError:
+            continue  # This system doesn't support this address family.
+        try:
+            sockObj.connect(address)
+            return True
+        except OSError:
+            pass
+        finally:
+            sockObj.close()
+    return False
+
+
+def _is_ipv4(ip):
+    # type: (str) -> bool
+    """Returns True if ip is a dotted-decimal IPv4 address like '69.89.31.226'. This uses the C-implemented
+    socket.inet_pton(), which is much cheaper than running IPV4_REGEX on every response."""
+    try:
+        socket.inet_pton(socket.AF_INET, ip)
+        return True
+    except (OSError, ValueError):  # ValueError is raised for strings with null characters.
+        return False
+
+
+def _is_ipv6(ip):
+    # type: (str) -> bool
+    """Returns True if ip is an IPv6 address like '2345:0425:2CA1:0000:0000:0567:5673:23b5'. Like _is_ipv4(), this uses
+    socket.inet_pton(), which parses the address in a single pass instead of trying the many backtracking alternations
+    in IPV6_REGEX."""
+    try:
+        socket.inet_pton(socket.AF_INET6, ip)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def _is_ip(ip):
+    # type: (str) -> bool
+    """Returns True if ip is either an IPv4 or an IPv6 address."""
+    return _is_ipv4(ip) or _is_ipv6(ip)
+
+
+# The function that validates the response from an IP website, for each ip_version argument of _get_ip_from_https():
+_IP_VALIDATORS = {4: _is_ipv4, 6: _is_ipv6, None: _is_ip}  # type: Dict[Optional[int], Callable[[str], bool]]
+
+
+def _get_ip_from_stun_or_https(stun_servers, ip_version=None):
+    # type: (Sequence[Tuple[str, int]], Optional[int]) -> Optional[str]
+    """Returns a str of your IP address from either the STUN servers in stun_servers (a sequence of (host, port)
+    tuples) or the "whatismyip" websites, whichever answers first. If offline or the IP address can't be determined,
+    this returns None.
+
+    This is like "Happy Eyeballs" (RFC 8305): the STUN servers get a short head start, and if they haven't answered by
+    then, the websites are queried while still waiting on the STUN servers. So a slow or blocked STUN server delays
+    the websites by STUN_HEAD_START seconds instead of its whole timeout."""
+    stopStun = threading.Event()
+    stunFuture = _EXECUTOR.submit(_get_ip_from_stun_parallel, stun_servers=stun_servers, stop_event=stopStun)
+    try:
+        try:
+            ip = stunFuture.result(timeout=STUN_HEAD_START)
+        except concurrent.futures.TimeoutError:
+            return _get_ip_from_https(ip_version, race_with=stunFuture)
+        except Exception:
+            ip = None  # The STUN lookup failed unexpectedly, so just use the websites.
+        if ip is not None:
+            return ip
+        return _get_ip_from_https(ip_version)  # The STUN servers already failed, so there's nothing to race.
+    finally:
+        # If the websites answered first, don't leave the STUN lookup running. (Running futures can't be cancelled,
+        # and the interpreter waits on the worker threads before exiting.)
+        stopStun.set()
+
+
+def _get_ip_from_https(ip_version=None, web_servers=None, race_with=None):
+    # type: (Optional[int], Optional[Sequence[str]], Optional[concurrent.futures.Future]) -> Optional[str]
     """Returns a str of your IPv4 or IPv6 address from a "whatismyip" website.
     If offline or the IP address can't be determined, this returns None.
 
@@ -198,128 +420,328 @@ def _get_ip_from_https(ip_version=None, web_servers=None):
     for either.
     :type ip_version: The ints 4 or 6, or None.
     :param web_servers: Optional sequence of websites that return an IP address,
-    similar to the ones in IP_WEBSITES."""
+    similar to the ones in IP_WEBSITES.
+    :param race_with: Optional Future of some other IP address lookup (that
+    returns a str or None) to wait on along with the websites. Whichever
+    valid IP address comes first is returned. If the lookup raises an
+    exception, it's treated like a None result."""
+
+    # Pick the validation function once, instead of checking ip_version on every response.
+    isValidIp = _IP_VALIDATORS.get(ip_version)
+    if isValidIp is None:
+        return None  # The ip_version argument is invalid.
 
     if web_servers is None:
-        # By default, we keep checking each website in IP_WEBSITES until
-        # we get a valid response.
+        # By default, we use every website in IP_WEBSITES.
         ipWebsites = list(IP_WEBSITES)
     else:
         ipWebsites = list(web_servers)
     random.shuffle(ipWebsites)
 
-    for ipWebsite in ipWebsites:  # Go through all ip website servers, return the first valid response.
-        try:
-            response = urllib.request.urlopen(ipWebsite)
-
-            charsets = response.info().get_charsets()
-            if len(charsets) == 0 or charsets[0] is None:
-                charset = 'utf-8'  # Use utf-8 by default
-            else:
-                charset = charsets[0]
-
-            userIp = response.read().decode(charset).strip()
-
-            if ip_version == 4 and IPV4_REGEX.match(userIp):
-                return userIp
-            elif ip_version == 6 and IPV6_REGEX.match(userIp):
-                return userIp
-            elif ip_version is None and (IPV4_REGEX.match(userIp) or IPV6_REGEX.match(userIp)):
-                return userIp
-            else:
-                # Either the ip_version argument is invalid or the ip website
-                # returned some unexpected text that is not an IP address.
-                # (Or the user asked for, say, ipv4 and got an ipv6 address.)
-                continue
-        except:
-            pass  # Network error, just continue on to next website.
+    # Query several websites at once and return the first valid response, so one slow website can't hold up the rest.
+    # Whenever a website fails, the next one is started in its place.
+    remainingWebsites = iter(ipWebsites)
+    futures = {_EXECUTOR.submit(_get_ip_from_website, ipWebsite, isValidIp)
+               for ipWebsite in itertools.islice(remainingWebsites, HTTPS_PARALLEL_REQUESTS)}
+    if race_with is not None:
+        futures.add(race_with)
+    try:
+        while futures:
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                userIp = future.result() if future.exception() is None else None
+                if userIp is not None:
+                    return userIp
+                if future is race_with:
+                    continue
+
+                nextWebsite = next(remainingWebsites, None)
+                if nextWebsite is not None:
+                    futures.add(_EXECUTOR.submit(_get_ip_from_website, nextWebsite, isValidIp))
+    finally:
+        for future in futures:
+            future.cancel()  # Don't bother starting requests that haven't started yet.
 
     # Either all of the websites are down or returned invalid response
     # (unlikely) or you are disconnected from the internet (likely).
     return None
 
 
-def _b2hex(abytes):
-    # type: (bytes) -> str
-    """Converts bytes to an ascii string of hex digits, e.g. """
-    return binascii.b2a_hex(abytes).decode('ascii')
+def _get_ip_from_website(ip_website, is_valid_ip=_is_ip):
+    # type: (str, Callable[[str], bool]) -> Optional[str]
+    """Returns a str of your IP address from a single "whatismyip" website. If there's a network error or the website's
+    response doesn't pass the is_valid_ip function (one of the functions in _IP_VALIDATORS), this returns None."""
+    try:
+        # IP addresses are plain ASCII, so the response's charset doesn't matter. Any non-ASCII bytes are replaced so
+        # that they make the response invalid instead of raising an exception.
+        userIp = _http_get(ip_website, HTTPS_TIMEOUT).decode('ascii', 'replace').strip()
+    except:
+        return None  # Network error.
+
+    if is_valid_ip(userIp):
+        return userIp
+    else:
+        # The ip website returned some unexpected text that is not an IP address.
+        # (Or the user asked for, say, ipv4 and got an ipv6 address.)
+        return None
+
+
+def _http_get(url, timeout, redirects=5):
+    # type: (str, float, int) -> bytes
+    """Sends a GET request to url over a pooled keep-alive connection and returns the response body, following up to
+    redirects redirects. Raises an exception on network errors, if the response status isn't 200, or if the body is
+    longer than _MAX_RESPONSE_LENGTH bytes.
+
+    If a proxy is configured for url (with the HTTP_PROXY or HTTPS_PROXY environment variables or the system's proxy
+    settings), the request goes through urllib.request.urlopen() instead, which knows how to talk to proxies."""
+    urlParts = urllib.parse.urlsplit(url)
+    if urlParts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(urlParts.hostname):
+        return _urlopen_get(url, timeout)
+
+    key = (urlParts.scheme, urlParts.hostname, urlParts.port)
+    path = urlParts.path or '/'
+    if urlParts.query:
+        path += '?' + urlParts.query
+
+    with _HTTP_CONNECTIONS_LOCK:
+        idleConnections = _HTTP_CONNECTIONS.get(key)
+        conn = idleConnections.pop() if idleConnections else None
+
+    while True:
+        isReused = conn is not None
+        if isReused:
+            conn.sock.settimeout(timeout)
+        elif urlParts.scheme == 'https':
+            conn = http.client.HTTPSConnection(urlParts.hostname, urlParts.port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(urlParts.hostname, urlParts.port, timeout=timeout)
+
+        try:
+            conn.request('GET', path, headers=HTTP_HEADERS)
+            response = conn.getresponse()
+            body = response.read(_MAX_RESPONSE_LENGTH + 1)  # One byte extra, to tell if the body is too long.
+            break
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not isReused:
+                raise
+            conn = None  # The server probably closed the idle connection, so retry once on a new one.
+
+    # The connection can only be reused if the whole response was read. (It isn't if the body was too long, and responses
+    # without a Content-Length are only known to be finished when the server closes the connection.)
+    isTooLong = len(body) > _MAX_RESPONSE_LENGTH
+    if response.will_close or not response.isclosed():
+        conn.close()
+    else:
+        with _HTTP_CONNECTIONS_LOCK:
+            _HTTP_CONNECTIONS.setdefault(key, []).append(conn)
+
+    location = response.getheader('Location')
+    if response.status in (301, 302, 303, 307, 308) and location and redirects > 0:
+        location = urllib.parse.urljoin(url, location)
+        if urllib.parse.urlsplit(location).scheme in ('http', 'https'):
+            return _http_get(location, timeout, redirects - 1)
+    if response.status != 200:
+        raise http.client.HTTPException('%s responded with HTTP status %s' % (url, response.status))
+    if isTooLong:
+        raise http.client.HTTPException('%s responded with more than %s bytes' % (url, _MAX_RESPONSE_LENGTH))
+
+    return body
+
+
+def _urlopen_get(url, timeout):
+    # type: (str, float) -> bytes
+    """Like _http_get(), but sends the request with urllib.request.urlopen(). This doesn't reuse connections, but it
+    handles proxies (and redirects) the same way the rest of the standard library does."""
+    request = urllib.request.Request(url, headers=HTTP_HEADERS)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read(_MAX_RESPONSE_LENGTH + 1)
+        if response.status != 200:
+            raise http.client.HTTPException('%s responded with HTTP status %s' % (url, response.status))
+    if len(body) > _MAX_RESPONSE_LENGTH:
+        raise http.client.HTTPException('%s responded with more than %s bytes' % (url, _MAX_RESPONSE_LENGTH))
+    return body
 
 
 def _get_ip_from_stun(stun_servers=None):
-    # type: (Optional[str], Optional[int]) -> Optional[str]
-    """Retrieves the IPv4 address from a STUN (Session Traversal Utilities for NAT) server. If stunHost and stunPort
-    aren't specified, then a public STUN server is randomly selected from the STUN_SERVERS tuple."""
-    SOURCE_IP = '0.0.0.0'
-    SOURCE_PORT = 54320
+    # type: (Optional[Sequence[Tuple[str, int]]]) -> Optional[str]
+    """Retrieves the IPv4 address from a STUN (Session Traversal Utilities for NAT) server. The server is randomly
+    selected from stun_servers, a sequence of (host, port) tuples, or from the STUN_SERVERS tuple if stun_servers isn't
+    specified."""
 
     if stun_servers is None:
         # If a STUN server isn't provided, use a random one from the STUN_SERVERS:
-        #stunHost, stunPortStr = random.choice(STUN_SERVERS).split(':')
-        #stunPort = int(stunPortStr)
-        stunServer = random.choice(STUN_SERVERS)
+        stunHost, stunPort = random.choice(_STUN_SERVERS_PARSED)
     else:
         # Pick a random STUN server from sources to use.
-        stunServer = random.choice(stun_servers)
-
-    # Turn the '0.0.0.0:54320' string in stunServer to '0.0.0.0' and 54320:
-    stunHost, stunPortStr = stunServer.split(':')
-    stunPort = int(stunPortStr)
-
-    sockObj = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sockObj.settimeout(2)
-    sockObj.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sockObj.bind((SOURCE_IP, SOURCE_PORT))
+        stunHost, stunPort = random.choice(stun_servers)
 
-    # STUN transaction IDs are arbitrary numbers:
-    transID = ''.join(random.choice('0123456789ABCDEF') for i in range(32))
+    # The socket isn't bound, so the OS picks an unused port for it on the first sendto(). The with statement makes
+    # sure the socket gets closed on every return path.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sockObj:
+        sockObj.settimeout(2)
 
-    data = binascii.a2b_hex(BIND_REQUEST_MSG + '0000' + transID)
-    while True:
-        attempts_remaining = 3
-        while True:
-            # Loop until we get a response or run out of retry attempts.
+        transID, data = _stun_bind_request()
+        for attempt in range(3):  # Make 3 attempts, since UDP packets can get lost.
             try:
-                sockObj.sendto(data, (stunHost, stunPort))
+                sockObj.sendto(data, _resolve(stunHost, stunPort))
             except socket.gaierror:
                 # Most likely you are offline.
                 return None
 
             try:
                 buf, addr = sockObj.recvfrom(2048)
-                break
             except Exception:
-                attempts_remaining -= 1
-                if attempts_remaining == 0:
-                    return None  # Could not connect to the stun server.
-
-        transIDMatch = transID.upper() == _b2hex(buf[4:20]).upper()
-        if transIDMatch and _b2hex(buf[0:2]) == BIND_RESPONSE_MSG:
-            message_remaining = int(_b2hex(buf[2:4]), 16)
-            base = 20
-            while message_remaining:
-                stunAttribute = _b2hex(buf[base:(base + 2)])
-                stunAttributeLength = int(_b2hex(buf[(base + 2):(base + 4)]), 16)
-
-                ip = '.'.join([
-                    str(int(_b2hex(buf[base + 8:base + 9]), 16)),
-                    str(int(_b2hex(buf[base + 9:base + 10]), 16)),
-                    str(int(_b2hex(buf[base + 10:base + 11]), 16)),
-                    str(int(_b2hex(buf[base + 11:base + 12]), 16))
-                ])
-
-                if stunAttribute == MAPPED_ADDRESS:
-                    # There are several IP addresses in the STUN response, but only MAPPED_ADDRESS is our user's IP.
-                    return ip
-                else:
-                    pass # We ignore all the other stun attributes.
+                continue  # No response, so try again.
+
+            if _is_stun_bind_response(buf, transID):
+                return _parse_stun_mapped_address(buf)
+
+    return None  # Could not connect to the stun server.
 
-                base += STUN_ATTR_LEN + stunAttributeLength
-                message_remaining -= STUN_ATTR_LEN + stunAttributeLength
-            break
 
-    sockObj.close()
-    return ip
+def _get_ip_from_stun_parallel(num_servers=5, stun_servers=None, timeout=2, stop_event=None):
+    # type: (int, Optional[Sequence[Tuple[str, int]]], float, Optional[threading.Event]) -> Optional[str]
+    """Sends a STUN bind request to several STUN servers at once and returns the IPv4 address from the first valid
+    response, or None if no server responds within timeout seconds. The servers are picked randomly from stun_servers,
+    a sequence of (host, port) tuples, or from the STUN_SERVERS tuple if stun_servers isn't specified. If stop_event is
+    given and gets set, this stops waiting and returns None within _STUN_STOP_CHECK_INTERVAL seconds."""
+    if stun_servers is None:
+        stun_servers = _STUN_SERVERS_PARSED
+    stunServers = _pick_stun_servers(stun_servers, num_servers)
+
+    # All of the requests go out back-to-back from one socket, which the OS binds to an unused port on the first
+    # sendto(). Each request has its own transaction ID, which is how the responses are matched up to them.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sockObj:
+        deadline = time.time() + timeout
+
+        # Look up the servers' addresses at the same time instead of one after another (this matters when they aren't
+        # in _DNS_CACHE yet), and send each request as soon as its server's address is known.
+        pendingRequests = {}  # type: Dict[bytes, Tuple[Tuple[str, int], float]]  # Maps transID to (server, send time).
+        futures = {_DNS_EXECUTOR.submit(_resolve, *stunServer): stunServer for stunServer in stunServers}
+        pendingLookups = set(futures)
+        while pendingLookups:
+            timeLeft = deadline - time.time()
+            if timeLeft <= 0:
+                break  # Don't wait any longer on the DNS lookups that haven't finished.
+            if stop_event is not None and stop_event.is_set():
+                return None
+            done, pendingLookups = concurrent.futures.wait(pendingLookups, min(timeLeft, _STUN_STOP_CHECK_INTERVAL),
+                                                           concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                transID, data = _stun_bind_request()
+                try:
+                    sockObj.sendto(data, future.result())
+                except OSError:
+                    continue  # Couldn't look up or reach this server (most likely you are offline).
+                pendingRequests[transID] = (futures[future], time.time())
+
+        while pendingRequests:
+            timeLeft = deadline - time.time()
+            if stop_event is not None and stop_event.is_set():
+                return None  # (The servers weren't given their full timeout, so this isn't recorded as a failure.)
+            if timeLeft <= 0:
+                # None of the remaining STUN servers responded in time.
+                for stunServer, sendTime in pendingRequests.values():
+                    _record_stun_result(stunServer, None)
+                return None
 
+            # (A socket timeout is used instead of select(), which fails on file descriptors above 1023.)
+            sockObj.settimeout(min(timeLeft, _STUN_STOP_CHECK_INTERVAL))
+            try:
+                buf, addr = sockObj.recvfrom(2048)
+            except socket.timeout:
+                continue  # Check stop_event and the deadline again.
+            except OSError:
+                continue  # Some platforms report an ICMP error from an earlier send here.
+
+            transID = buf[4:20]
+            if transID in pendingRequests and _is_stun_bind_response(buf, transID):
+                stunServer, sendTime = pendingRequests.pop(transID)
+                ip = _parse_stun_mapped_address(buf)
+                _record_stun_result(stunServer, None if ip is None else time.time() - sendTime)
+                if ip is not None:
+                    return ip
+        return None
+
+
+def _pick_stun_servers(stun_servers, num_servers):
+    # type: (Sequence[Tuple[str, int]], int) -> List[Tuple[str, int]]
+    """Returns a list of num_servers different servers picked randomly from stun_servers. The picks are weighted by the
+    servers' records in _STUN_STATS, so servers that have been answering quickly are picked more often than servers
+    that are slow or keep failing. (Servers are never ruled out completely, so ones that come back up get picked
+    again.)"""
+    def weight(stunServer):
+        successes, failures, latency = _STUN_STATS.get(stunServer, _DEFAULT_STUN_STATS)
+        return successes / (successes + failures) / (latency + 0.05)
+
+    # Weighted random sampling without replacement (the Efraimidis-Spirakis algorithm): give each server a random key
+    # of random() ** (1 / weight) and take the servers with the largest keys.
+    return sorted(stun_servers, key=lambda stunServer: random.random() ** (1 / weight(stunServer)),
+                  reverse=True)[:num_servers]
+
+
+def _record_stun_result(stun_server, latency):
+    # type: (Tuple[str, int], Optional[float]) -> None
+    """Updates stun_server's record in _STUN_STATS with a successful response that took latency seconds, or with a
+    failure if latency is None."""
+    with _STUN_STATS_LOCK:  # Several lookups can finish at the same time.
+        successes, failures, avgLatency = _STUN_STATS.get(stun_server, _DEFAULT_STUN_STATS)
+        if latency is None:
+            _STUN_STATS[stun_server] = (successes, failures + 1, avgLatency)
+        else:
+            # The average latency is an exponentially weighted moving average, so it follows recent changes.
+            _STUN_STATS[stun_server] = (successes + 1, failures, 0.8 * avgLatency + 0.2 * latency)
+
+
+def _resolve(host, port):
+    # type: (str, int) -> Tuple[str, int]
+    """Returns the IPv4 socket address for host and port. The DNS lookup is cached for DNS_CACHE_TTL seconds, so
+    repeated STUN requests to the same server skip it."""
+    now = time.time()
+    cached = _DNS_CACHE.get((host, port))
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    sockaddr = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+    _DNS_CACHE[(host, port)] = (sockaddr, now + DNS_CACHE_TTL)
+    return sockaddr
+
+
+def _stun_bind_request():
+    # type: () -> Tuple[bytes, bytes]
+    """Returns a tuple of a new random STUN transaction ID and the bind request message that uses it."""
+    # Apart from the magic cookie (which tells servers we understand XOR-MAPPED-ADDRESS), transaction IDs are random.
+    transID = _MAGIC_COOKIE + os.urandom(12)
+    return transID, struct.pack('!HH', _BIND_REQUEST, 0) + transID
+
+
+def _is_stun_bind_response(buf, transID):
+    # type: (bytes, bytes) -> bool
+    """Returns True if buf is the response to the STUN bind request with the transaction ID transID."""
+    return len(buf) >= 20 and struct.unpack_from('!H', buf)[0] == _BIND_RESPONSE and buf[4:20] == transID
+
+
+def _parse_stun_mapped_address(buf):
+    # type: (bytes) -> Optional[str]
+    """Returns the IPv4 address in the MAPPED-ADDRESS or XOR-MAPPED-ADDRESS attribute of the STUN bind response in
+    buf, or None if it has neither. (Modern RFC 5389 servers often only send XOR-MAPPED-ADDRESS.)"""
+    messageEnd = min(20 + struct.unpack_from('!H', buf, 2)[0], len(buf))
+    base = 20
+    while base + STUN_ATTR_LEN <= messageEnd:
+        stunAttribute, stunAttributeLength = struct.unpack_from('!HH', buf, base)
+
+        # There are several IP addresses in the STUN response, but only the (XOR-)MAPPED-ADDRESS is our user's IP.
+        # (We ignore all the other stun attributes.) Byte 5 of the attribute is the address family, 1 for IPv4.
+        if stunAttribute in (_MAPPED_ADDRESS, _XOR_MAPPED_ADDRESS) and base + 12 <= messageEnd and buf[base + 5] == 1:
+            octets = buf[base + 8:base + 12]
+            if stunAttribute == _XOR_MAPPED_ADDRESS:
+                octets = bytes(octet ^ cookieByte for octet, cookieByte in zip(octets, _MAGIC_COOKIE))
+            return '%d.%d.%d.%d' % tuple(octets)
+
+        # Attribute values are padded to a multiple of 4 bytes.
+        base += STUN_ATTR_LEN + (stunAttributeLength + 3) // 4 * 4
+    return None
 
 
 def _profile_stun_servers():
@@ -327,11 +749,11 @@ def _profile_stun_servers():
     import time
     import pprint
     results = []
-    for stunServer in STUN_SERVERS:
+    for stunServer, stunServerParsed in zip(STUN_SERVERS, _STUN_SERVERS_PARSED):
         elapsedTimes = []
         for i in range(3):  # Get the average of 3 timings.
             startTime = time.time()
-            resultIp = _get_ip_from_stun([stunServer])
+            resultIp = _get_ip_from_stun([stunServerParsed])
             elapsedTimes.append(round(time.time() - startTime, 2))
             time.sleep(0.1)  # Maybe this pause is not needed? I'm being superstitious.
         elapsedTime = sum(elapsedTimes) / 3
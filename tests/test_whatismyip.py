@@ -1,8 +1,114 @@
 from __future__ import division, print_function
+import concurrent.futures
+import http.server
+import socket
+import socketserver
+import struct
+import threading
+import time
 import pytest
 import whatismyip
 
 
+class FakeIpWebsiteHandler(http.server.BaseHTTPRequestHandler):
+    """Responds to GET requests like an IP website. The path picks the response: /ip sends an IP address with a
+    Content-Length, /chunked sends it with chunked encoding, /close sends it without a length and then closes the
+    connection, /long sends a body that is too long to be an IP address, and /redirect redirects to /ip. The paths
+    that were requested are recorded in the server's paths list."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clientPorts.append(self.client_address[1])
+        self.server.paths.append(self.path)
+        if self.path == '/redirect':
+            self.send_response(301)
+            self.send_header('Location', '/ip')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = b'9' * 1000 if self.path.endswith('/long') else b'69.89.31.226\n'
+        self.send_response(200)
+        if self.path.startswith('/chunked'):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body))
+        elif self.path.startswith('/close'):
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body)
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Keep the test output quiet.
+
+
+class FakeStunServer(object):
+    """Answers STUN bind requests on the loopback interface with a MAPPED-ADDRESS of 69.89.31.226. Before each answer,
+    it sends a response with the wrong transaction ID. Set silent to True to make it stop answering."""
+    def __init__(self):
+        self.silent = False
+        self.sockObj = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sockObj.bind(('127.0.0.1', 0))
+        self.address = self.sockObj.getsockname()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        attributes = struct.pack('!HHBBH', 0x0001, 8, 0, 1, 54320) + bytes([69, 89, 31, 226])
+        while True:
+            try:
+                data, addr = self.sockObj.recvfrom(2048)
+            except OSError:
+                return  # The socket was closed.
+            if not self.silent:
+                wrongTransID = bytes(b ^ 0xff for b in data[4:20])
+                for transID in (wrongTransID, data[4:20]):
+                    self.sockObj.sendto(struct.pack('!HH', 0x0101, len(attributes)) + transID + attributes, addr)
+
+    def close(self):
+        self.sockObj.close()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def ip_website_server(monkeypatch):
+    """Runs a FakeIpWebsiteHandler server on the loopback interface and yields it."""
+    for name in ('http_proxy', 'HTTP_PROXY'):
+        monkeypatch.delenv(name, raising=False)  # Talk to the server directly, even if the system has a proxy.
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeIpWebsiteHandler)
+    server.clientPorts = []
+    server.paths = []
+    server.url = 'http://127.0.0.1:%d' % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    whatismyip._HTTP_CONNECTIONS.clear()
+
+
+@pytest.fixture
+def ip_website(ip_website_server):
+    """Yields the base URL of the ip_website_server."""
+    yield ip_website_server.url
+
+
+@pytest.fixture
+def stun_server(monkeypatch):
+    """Runs a FakeStunServer with a fresh _STUN_STATS and yields it."""
+    monkeypatch.setattr(whatismyip, '_STUN_STATS', {})
+    server = FakeStunServer()
+    yield server
+    server.close()
+
+
 def test_basic():
     # This is a fake web page I set up on my inventwithpython.com website.
     assert whatismyip.whatismyip(sources=('https://inventwithpython.com/whatismyip/',)) == '99.99.99.99'
@@ -16,6 +122,224 @@ def test_basic():
     assert whatismyip.amionline()
     assert whatismyip.amionline(web_servers=whatismyip.ONLINE_WEB_SERVERS)
 
+def test_is_ipv4():
+    assert whatismyip._is_ipv4('69.89.31.226')
+    assert whatismyip._is_ipv4('0.0.0.0')
+    assert whatismyip._is_ipv4('255.255.255.255')
+
+    assert not whatismyip._is_ipv4('256.0.0.1')
+    assert not whatismyip._is_ipv4('1.2.3')
+    assert not whatismyip._is_ipv4('1.2.3.4.5')
+    assert not whatismyip._is_ipv4('1.2.3.')
+    assert not whatismyip._is_ipv4('1.2.3.0004')
+    assert not whatismyip._is_ipv4('1.2.3.-4')
+    assert not whatismyip._is_ipv4('1.2.3.\u00b2')
+    assert not whatismyip._is_ipv4('2345:0425:2CA1:0000:0000:0567:5673:23b5')
+    assert not whatismyip._is_ipv4('')
+    assert not whatismyip._is_ipv4('1.2.3.4\x00')
+
+def test_is_ipv6():
+    assert whatismyip._is_ipv6('2345:0425:2CA1:0000:0000:0567:5673:23b5')
+    assert whatismyip._is_ipv6('2001:db8::1')
+    assert whatismyip._is_ipv6('::')
+    assert whatismyip._is_ipv6('::ffff:192.0.2.33')
+
+    assert not whatismyip._is_ipv6('69.89.31.226')
+    assert not whatismyip._is_ipv6('2001:db8::1::2')
+    assert not whatismyip._is_ipv6('12345::1')
+    assert not whatismyip._is_ipv6('<html>')
+    assert not whatismyip._is_ipv6('')
+
+def test_ip_regexes():
+    assert whatismyip.IPV4_REGEX.match('69.89.31.226')
+    assert not whatismyip.IPV4_REGEX.match('69.89.31.226.')
+    assert not whatismyip.IPV4_REGEX.match('69.89.31.2267')
+    assert not whatismyip.IPV4_REGEX.match('69.89.31.226\n')
+
+    assert whatismyip.IPV6_REGEX.match('2345:0425:2CA1:0000:0000:0567:5673:23b5')
+    assert whatismyip.IPV6_REGEX.match('1::8')
+    assert not whatismyip.IPV6_REGEX.match('1::2::3')
+    assert not whatismyip.IPV6_REGEX.match('69.89.31.226')
+    assert not whatismyip.IPV6_REGEX.match('::1\n')
+
+def test_parse_stun_response():
+    transID, request = whatismyip._stun_bind_request()
+    assert len(transID) == 16
+    assert transID.startswith(b'\x21\x12\xa4\x42')  # The RFC 5389 magic cookie.
+    assert request == b'\x00\x01\x00\x00' + transID
+
+    # A bind response with a 5-byte (padded to 8) SOFTWARE attribute before the MAPPED_ADDRESS attribute:
+    attributes = (struct.pack('!HH', 0x8022, 5) + b'stun\x00\x00\x00\x00' +
+                  struct.pack('!HHBBH', 0x0001, 8, 0, 1, 54320) + bytes([69, 89, 31, 226]))
+    response = struct.pack('!HH', 0x0101, len(attributes)) + transID + attributes
+    assert whatismyip._is_stun_bind_response(response, transID)
+    assert not whatismyip._is_stun_bind_response(response, bytes(16))
+    assert not whatismyip._is_stun_bind_response(response[:19], transID)
+    assert whatismyip._parse_stun_mapped_address(response) == '69.89.31.226'
+
+    # A response with an XOR-MAPPED-ADDRESS attribute instead:
+    attributes = struct.pack('!HHBBH', 0x0020, 8, 0, 1, 54320 ^ 0x2112) + bytes([69 ^ 0x21, 89 ^ 0x12, 31 ^ 0xa4, 226 ^ 0x42])
+    xorResponse = struct.pack('!HH', 0x0101, len(attributes)) + transID + attributes
+    assert whatismyip._parse_stun_mapped_address(xorResponse) == '69.89.31.226'
+
+    # A response with no MAPPED_ADDRESS attribute, or one that is cut off:
+    assert whatismyip._parse_stun_mapped_address(response[:28]) is None
+    assert whatismyip._parse_stun_mapped_address(response[:-2]) is None
+
+def test_ttl_cache():
+    calls = []
+
+    @whatismyip._ttl_cache(60)
+    def lookup(arg=None):
+        calls.append(arg)
+        return arg
+
+    assert lookup(1) == 1
+    assert lookup(1) == 1
+    assert lookup(arg=1) == 1
+    assert calls == [1, 1]  # Positional and keyword arguments are cached separately.
+
+    assert lookup() is None
+    assert lookup() is None
+    assert calls == [1, 1, None, None]  # None results aren't cached.
+
+    lookup.cache_clear()
+    assert lookup(1) == 1
+    assert calls == [1, 1, None, None, 1]
+
+    lookup.ttl = 0
+    lookup.cache_clear()
+    assert lookup(1) == 1
+    assert lookup(1) == 1
+    assert calls == [1, 1, None, None, 1, 1, 1]
+
+def test_http_get_response_lengths(ip_website):
+    for path in ('/ip', '/chunked', '/close'):
+        assert whatismyip._http_get(ip_website + path, 2) == b'69.89.31.226\n'
+        assert whatismyip._get_ip_from_website(ip_website + path) == '69.89.31.226'
+
+        with pytest.raises(whatismyip.http.client.HTTPException):
+            whatismyip._http_get(ip_website + path + '/long', 2)
+        assert whatismyip._get_ip_from_website(ip_website + path + '/long') is None
+
+def test_http_get_redirects_and_proxies(ip_website_server, monkeypatch):
+    assert whatismyip._http_get(ip_website_server.url + '/redirect', 2) == b'69.89.31.226\n'
+    assert ip_website_server.paths == ['/redirect', '/ip']
+    with pytest.raises(whatismyip.http.client.HTTPException):
+        whatismyip._http_get(ip_website_server.url + '/redirect', 2, redirects=0)
+
+    # With a proxy configured, the request is sent to the proxy (which here is the fake IP website itself):
+    monkeypatch.setenv('http_proxy', ip_website_server.url)
+    monkeypatch.delenv('no_proxy', raising=False)
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    assert whatismyip._http_get('http://ip.example.com/ip', 2) == b'69.89.31.226\n'
+    assert ip_website_server.paths[-1] == 'http://ip.example.com/ip'
+
+def test_http_get_reuses_connections(ip_website_server):
+    url = ip_website_server.url + '/ip'
+    assert whatismyip._http_get(url, 2) == b'69.89.31.226\n'
+    assert whatismyip._http_get(url, 2) == b'69.89.31.226\n'
+    assert len(set(ip_website_server.clientPorts)) == 1
+
+    # If the server has closed the idle connection, the request is retried on a new one:
+    for conn in whatismyip._HTTP_CONNECTIONS[('http', '127.0.0.1', ip_website_server.server_port)]:
+        conn.sock.shutdown(socket.SHUT_RDWR)
+    assert whatismyip._http_get(url, 2) == b'69.89.31.226\n'
+    assert len(set(ip_website_server.clientPorts)) == 2
+
+def test_get_ip_from_https(ip_website, monkeypatch):
+    # With one request at a time, each failed website is replaced by the next one until one succeeds:
+    monkeypatch.setattr(whatismyip, 'HTTPS_PARALLEL_REQUESTS', 1)
+    websites = [ip_website + '/long', ip_website + '/chunked/long', ip_website + '/ip']
+    assert whatismyip._get_ip_from_https(web_servers=websites) == '69.89.31.226'
+    assert whatismyip._get_ip_from_https(6, web_servers=websites) is None
+    assert whatismyip._get_ip_from_https(5, web_servers=websites) is None
+
+    # The race_with future's IP address is returned if it's the only valid one, and ignored if it's None:
+    raceWith = concurrent.futures.Future()
+    raceWith.set_result('5.6.7.8')
+    assert whatismyip._get_ip_from_https(web_servers=websites[:2], race_with=raceWith) == '5.6.7.8'
+    raceWith = concurrent.futures.Future()
+    raceWith.set_result(None)
+    assert whatismyip._get_ip_from_https(web_servers=websites, race_with=raceWith) == '69.89.31.226'
+    assert whatismyip._get_ip_from_https(web_servers=websites[:2], race_with=raceWith) is None
+
+    # A race_with future that raised an exception counts as a None result:
+    raceWith = concurrent.futures.Future()
+    raceWith.set_exception(ValueError('filedescriptor out of range in select()'))
+    assert whatismyip._get_ip_from_https(web_servers=[], race_with=raceWith) is None
+    assert whatismyip._get_ip_from_https(web_servers=websites, race_with=raceWith) == '69.89.31.226'
+
+def test_get_ip_from_stun_or_https_exceptions(ip_website, monkeypatch):
+    # If the STUN lookup raises an exception, the websites are still used:
+    def failing_stun_lookup(**kwargs):
+        raise ValueError('filedescriptor out of range in select()')
+    monkeypatch.setattr(whatismyip, '_get_ip_from_stun_parallel', failing_stun_lookup)
+    monkeypatch.setattr(whatismyip, 'IP_WEBSITES', (ip_website + '/ip',))
+    assert whatismyip._get_ip_from_stun_or_https([]) == '69.89.31.226'
+
+def test_get_ip_from_stun_parallel(stun_server):
+    # The response with the wrong transaction ID is ignored:
+    assert whatismyip._get_ip_from_stun_parallel(stun_servers=[stun_server.address]) == '69.89.31.226'
+    assert whatismyip._STUN_STATS[stun_server.address][:2] == (2, 0)  # (successes, failures)
+
+    stun_server.silent = True
+    startTime = time.time()
+    assert whatismyip._get_ip_from_stun_parallel(stun_servers=[stun_server.address], timeout=0.2) is None
+    assert time.time() - startTime < 1
+    assert whatismyip._STUN_STATS[stun_server.address][:2] == (2, 1)
+
+    # Setting stop_event makes it stop waiting right away, without recording a failure:
+    stopEvent = threading.Event()
+    threading.Timer(0.1, stopEvent.set).start()
+    startTime = time.time()
+    assert whatismyip._get_ip_from_stun_parallel(stun_servers=[stun_server.address], stop_event=stopEvent) is None
+    assert time.time() - startTime < 1
+    assert whatismyip._STUN_STATS[stun_server.address][:2] == (2, 1)
+
+def test_concurrent_stun_lookups(stun_server, monkeypatch):
+    # Many lookups at once mustn't use up the thread pool that their own DNS lookups run on. (The lookups all wait on
+    # allSubmitted, so that they look up their servers at the same time.)
+    monkeypatch.setattr(whatismyip, '_DNS_CACHE', {})
+    allSubmitted = threading.Event()
+    pick_stun_servers = whatismyip._pick_stun_servers
+    def waiting_pick_stun_servers(stun_servers, num_servers):
+        allSubmitted.wait(5)
+        return pick_stun_servers(stun_servers, num_servers)
+    monkeypatch.setattr(whatismyip, '_pick_stun_servers', waiting_pick_stun_servers)
+
+    stunServer = ('localhost', stun_server.address[1])
+    futures = [whatismyip._EXECUTOR.submit(whatismyip._get_ip_from_stun_parallel, stun_servers=[stunServer])
+               for i in range(40)]
+    allSubmitted.set()
+    assert [future.result() for future in futures] == ['69.89.31.226'] * 40
+
+def test_amionline(monkeypatch):
+    lookups = []
+    def fake_getaddrinfo(host, port):
+        lookups.append(host)
+        raise socket.gaierror('offline')
+    monkeypatch.setattr(socket, 'getaddrinfo', fake_getaddrinfo)
+
+    # Without a route to the internet, no lookups are made at all:
+    monkeypatch.setattr(whatismyip, '_has_internet_route', lambda: False)
+    assert whatismyip.amionline() is False
+    assert lookups == []
+
+    # Three random web servers are looked up, and any successful lookup means the system is online:
+    monkeypatch.setattr(whatismyip, '_has_internet_route', lambda: True)
+    assert whatismyip.amionline(web_servers=['a.example', 'b.example', 'c.example', 'd.example']) is False
+    assert len(lookups) == 3
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda host, port: [])
+    assert whatismyip.amionline(web_servers=['a.example']) is True
+
+    # Lookups that take longer than AMIONLINE_TIMEOUT count as failures:
+    monkeypatch.setattr(whatismyip, 'AMIONLINE_TIMEOUT', 0.1)
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda host, port: time.sleep(1))
+    startTime = time.time()
+    assert whatismyip.amionline(web_servers=['a.example']) is False
+    assert time.time() - startTime < 0.9
+
 def test_can_connect_to_whatismyip_websites():
     for server in whatismyip.IP4_WEBSITES:
         pass